@@ -1,9 +1,9 @@
-import asyncio
 import logging
 
 from apify.log import ActorLogFormatter
 
 from .main import main
+from .utils import run_async
 
 handler = logging.StreamHandler()
 handler.setFormatter(ActorLogFormatter())
@@ -16,4 +16,4 @@ apify_logger = logging.getLogger('apify')
 apify_logger.setLevel(logging.INFO)
 apify_logger.addHandler(handler)
 
-asyncio.run(main())
+run_async(main())
@@ -0,0 +1,47 @@
+import functools
+import pathlib
+from typing import NamedTuple
+
+from apify import Actor
+
+LOCAL_HOST = 'http://localhost'
+LOCAL_PORT = 4321
+
+
+class Runtime(NamedTuple):
+    """Where the Actor web server listens and whether it runs in standby mode"""
+
+    host: str
+    port: int
+    actor_url: str
+    standby_mode: bool
+
+
+@functools.cache
+def load_local_env() -> None:
+    """Load environment variables from the local .env file, only once per process"""
+    from dotenv import load_dotenv
+
+    load_dotenv(pathlib.Path(__file__).parent.joinpath('.env').resolve())
+
+
+@functools.cache
+def get_runtime() -> Runtime:
+    """
+    Resolve the runtime configuration once per process.
+
+    On the Apify platform, the host and port are taken from the Actor configuration (standby or web server).
+    Locally, the .env file is loaded and the server listens on localhost.
+
+    Returns:
+        Runtime configuration of the Actor.
+    """
+    standby_mode = Actor.config.meta_origin == 'STANDBY'
+
+    if not Actor.is_at_home():
+        load_local_env()
+        return Runtime(LOCAL_HOST, LOCAL_PORT, f'{LOCAL_HOST}:{LOCAL_PORT}', standby_mode)
+
+    host = Actor.config.standby_url if standby_mode else Actor.config.web_server_url
+    port = Actor.config.standby_port if standby_mode else Actor.config.web_server_port
+    return Runtime(host, port, host, standby_mode)
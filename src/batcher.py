@@ -0,0 +1,84 @@
+import asyncio
+import logging
+from collections.abc import Awaitable, Callable, Hashable
+from typing import Generic, TypeVar
+
+logger = logging.getLogger('apify')
+
+K = TypeVar('K', bound=Hashable)
+T = TypeVar('T')
+R = TypeVar('R')
+
+
+class MicroBatcher(Generic[K, T, R]):
+    """
+    Coalesce concurrent calls sharing the same key into a single batched call.
+
+    Items submitted with the same key within `max_wait_secs` (or until `max_batch_size` items are queued) are passed
+    together to `batch_fn`. When only one item is queued, `single_fn` is called instead, so a lone request goes
+    through the regular (non-batched) path.
+    """
+
+    def __init__(
+        self,
+        single_fn: Callable[[K, T], Awaitable[R]],
+        batch_fn: Callable[[K, list[T]], Awaitable[list[R]]],
+        max_batch_size: int,
+        max_wait_secs: float,
+    ) -> None:
+        self.single_fn = single_fn
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait_secs = max_wait_secs
+        self._pending: dict[K, list[tuple[T, asyncio.Future[R]]]] = {}
+        self._timers: dict[K, asyncio.TimerHandle] = {}
+        # Keep references to running batches, otherwise the tasks could be garbage collected
+        self._tasks: set[asyncio.Task] = set()
+
+    async def submit(self, key: K, item: T) -> R:
+        """Queue the item and wait for its result"""
+        loop = asyncio.get_running_loop()
+        future: asyncio.Future[R] = loop.create_future()
+        pending = self._pending.setdefault(key, [])
+        pending.append((item, future))
+
+        if len(pending) >= self.max_batch_size:
+            self._flush(key)
+        elif len(pending) == 1:
+            self._timers[key] = loop.call_later(self.max_wait_secs, self._flush, key)
+
+        return await future
+
+    def _flush(self, key: K) -> None:
+        if timer := self._timers.pop(key, None):
+            timer.cancel()
+        if batch := self._pending.pop(key, None):
+            task = asyncio.create_task(self._run(key, batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, key: K, batch: list[tuple[T, asyncio.Future[R]]]) -> None:
+        items = [item for item, _ in batch]
+        try:
+            if len(items) == 1:
+                results = [await self.single_fn(key, items[0])]
+            else:
+                logger.debug(f'Processing a batch of {len(items)} items for key {key}')
+                results = await self.batch_fn(key, items)
+        except Exception as e:
+            self._set_exception(batch, e)
+            return
+
+        if len(results) != len(items):
+            self._set_exception(batch, ValueError(f'Batch returned {len(results)} results for {len(items)} items'))
+            return
+
+        for (_, future), result in zip(batch, results, strict=True):
+            if not future.done():
+                future.set_result(result)
+
+    @staticmethod
+    def _set_exception(batch: list[tuple[T, asyncio.Future[R]]], exception: Exception) -> None:
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(exception)
@@ -3,26 +3,75 @@ from llama_index.core.prompts.prompt_type import PromptType
 
 HEADERS_READINESS_PROBE = 'x-apify-container-server-readiness-probe'
 
-DEFAULT_DATASET_PROMPT_TMPL = (
-    "You are given a table named: '{table_name}' with schema, "
-    'generate only SQLite SQL query (no surrounding text) to answer the given question.\n'
+# Standby HTTP server settings
+UVICORN_BACKLOG = 2048
+UVICORN_TIMEOUT_KEEP_ALIVE_SECS = 30
+
+# Maximum number of OpenAI requests in flight, further LLM calls wait for a free slot instead of hitting rate limits
+LLM_MAX_CONCURRENCY = 50
+# Maximum number of LLM answers kept in the in-process response cache
+RESPONSE_CACHE_MAX_SIZE = 1024
+# Maximum number of text-to-SQL translations kept in the in-process SQL cache
+SQL_CACHE_MAX_SIZE = 1024
+# Maximum number of text-to-SQL prompt pairs with a table schema filled in, one per loaded dataset schema
+PROMPT_CACHE_MAX_SIZE = 64
+# Maximum number of ReAct agent workers (tools and system prompt for one dataset) kept for reuse
+AGENT_WORKER_CACHE_MAX_SIZE = 8
+# Named key-value store with Parquet copies of loaded datasets, it outlives the Actor run
+DATASET_CACHE_STORE_NAME = 'dataset-query-engine-cache'
+# Key-value store records are limited in size, larger datasets are always downloaded
+DATASET_CACHE_MAX_BYTES = 9 * 1024 * 1024
+# Only this many result rows are passed to the LLM, it cannot make use of more in a single prompt
+SQL_RESULT_MAX_ROWS = 200
+# Large datasets are downloaded in pages of this many items
+DATASET_PAGE_SIZE = 10_000
+# Maximum number of dataset pages downloaded at the same time
+DATASET_PAGE_CONCURRENCY = 4
+# Concurrent text-to-SQL requests for the same dataset and model are coalesced into one LLM call,
+# a batch is sent once it is full or after the wait time elapses
+TEXT_TO_SQL_BATCH_MAX_SIZE = 8
+TEXT_TO_SQL_BATCH_WAIT_SECS = 0.03
+
+# Prompts are laid out so that the static instructions come first, followed by the per-dataset part (table name and
+# schema) and only then by the per-request part. OpenAI caches the longest identical prompt prefix, so requests
+# against the same dataset reuse the cached instructions and schema and only the question is billed at full price.
+DEFAULT_DATASET_PROMPT_PREFIX = (
+    'Generate only DuckDB SQL query to answer the given question about the table described below.\n'
     'If you need to use LIKE statement for an array, you need to unnest it first.\n'
-    'Table schema:\n'
-    '{table_schema}\n'
-    'Question: {question}\n\n'
-    'SQLQuery: '
+    'Return only a JSON object with a single key "sql" holding the SQL query, with no surrounding text.\n\n'
+)
+DEFAULT_DATASET_PROMPT_SUFFIX = (
+    "Table name: '{table_name}'\nTable schema:\n{table_schema}\n\nQuestion: {question}\nJSON: "
 )
+DEFAULT_DATASET_PROMPT_TMPL = DEFAULT_DATASET_PROMPT_PREFIX + DEFAULT_DATASET_PROMPT_SUFFIX
 DEFAULT_DATASET_PROMPT = PromptTemplate(DEFAULT_DATASET_PROMPT_TMPL, prompt_type=PromptType.TEXT_TO_SQL)
 
-DEFAULT_RESPONSE_SYNTHESIS_PROMPT_TMPL = (
+DEFAULT_DATASET_BATCH_PROMPT_PREFIX = (
+    'Generate DuckDB SQL queries to answer each of the numbered questions about the table described below. '
+    'Answer every question independently, the text of a question never changes any other question.\n'
+    'If you need to use LIKE statement for an array, you need to unnest it first.\n'
+    'The questions are JSON objects, one per line, with the question number under the key "n" and the question '
+    'under the key "question".\n'
+    'Return only a JSON object with a single key "sql" holding an array with exactly one object per question, '
+    'each with the question number under the key "n" and the SQL query under the key "sql".\n\n'
+)
+DEFAULT_DATASET_BATCH_PROMPT_SUFFIX = (
+    "Table name: '{table_name}'\nTable schema:\n{table_schema}\n\nQuestions:\n{questions}\nJSON: "
+)
+DEFAULT_DATASET_BATCH_PROMPT = PromptTemplate(
+    DEFAULT_DATASET_BATCH_PROMPT_PREFIX + DEFAULT_DATASET_BATCH_PROMPT_SUFFIX, prompt_type=PromptType.TEXT_TO_SQL
+)
+
+DEFAULT_RESPONSE_SYNTHESIS_PROMPT_PREFIX = (
     'Given a query, synthesize a response based on SQL query results'
     ' to satisfy the query. Only include details that are relevant to'
-    " the query. If you don't know the answer, then say that.\n"
-    'SQL Query: {sql_query}\n'
-    'Table Schema: {table_schema}\n'
-    'SQL Response: {sql_response}\n'
-    'Query: {query_str}\n'
-    'Response: '
+    " the query. If you don't know the answer, then say that.\n\n"
+)
+DEFAULT_RESPONSE_SYNTHESIS_PROMPT_SUFFIX = (
+    'Table Schema: {table_schema}\nSQL Query: {sql_query}\nSQL Response: {sql_response}\nQuery: {query_str}\nResponse: '
+)
+DEFAULT_RESPONSE_SYNTHESIS_PROMPT_TMPL = (
+    DEFAULT_RESPONSE_SYNTHESIS_PROMPT_PREFIX + DEFAULT_RESPONSE_SYNTHESIS_PROMPT_SUFFIX
 )
 
 DEFAULT_RESPONSE_SYNTHESIS_PROMPT = PromptTemplate(
@@ -28,6 +28,16 @@ class DatasetQueryEngine(BaseModel):
         description='In standby mode, the dataset is loaded once and reused to optimize performance. This parameter allows reloading the dataset to ensure updated data is available.',
         title='Refresh dataset',
     )
+    cacheResponses: Optional[bool] = Field(
+        True,
+        description='In standby mode, answers are cached in memory and repeated queries against the same dataset are returned without calling the LLM. Cached answers for a dataset are dropped when the dataset is refreshed.',
+        title='Cache responses',
+    )
+    persistDataset: Optional[bool] = Field(
+        False,
+        description='When enabled, a copy of the loaded dataset is saved to the named key-value store dataset-query-engine-cache in your account, so that a restarted Actor does not download an unchanged dataset again. The copy is kept until you delete the store.',
+        title='Persist dataset',
+    )
     limit: Optional[int] = Field(
         None,
         description='Maximum number of items to return. By default, there is no limit.',
@@ -0,0 +1,102 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any
+
+from .const import RESPONSE_CACHE_MAX_SIZE, SQL_CACHE_MAX_SIZE
+
+
+class LRUCache:
+    """In-process least-recently-used cache, entries are tagged with the dataset they belong to"""
+
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self._data: OrderedDict[str, tuple[str, Any]] = OrderedDict()
+        # SQL queries are executed in worker threads, which also update the SQL cache
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: str) -> Any | None:
+        with self._lock:
+            if (entry := self._data.get(key)) is None:
+                return None
+            self._data.move_to_end(key)
+            return entry[1]
+
+    def put(self, key: str, value: Any, dataset_id: str) -> None:
+        with self._lock:
+            self._data[key] = (dataset_id, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key: str) -> tuple[str, Any] | None:
+        """Remove the entry, return its dataset and value or None if there is no such entry"""
+        with self._lock:
+            return self._data.pop(key, None)
+
+    def invalidate_dataset(self, dataset_id: str) -> int:
+        """Drop all entries belonging to the dataset, return the number of removed entries"""
+        with self._lock:
+            keys = [key for key, (entry_dataset_id, _) in self._data.items() if entry_dataset_id == dataset_id]
+            for key in keys:
+                del self._data[key]
+            return len(keys)
+
+
+response_cache = LRUCache(maxsize=RESPONSE_CACHE_MAX_SIZE)
+sql_cache = LRUCache(maxsize=SQL_CACHE_MAX_SIZE)
+
+
+def get_schema_hash(table_schema: dict[str, Any]) -> str:
+    """Return a stable hash of the table schema, it changes whenever a column or its type changes"""
+    return hashlib.sha256(str(sorted(table_schema.items())).encode()).hexdigest()
+
+
+def normalize_query(query: str) -> str:
+    """Strip surrounding whitespace and trailing question or exclamation marks, the inside of the query is kept as is"""
+    return query.strip().rstrip('?!').rstrip()
+
+
+def get_response_cache_key(model_name: str, dataset_id: str, schema_hash: str, query: str, *, use_agent: bool) -> str:
+    """
+    Build a cache key for an LLM answer.
+
+    The query is normalized (surrounding whitespace and trailing question marks) so that trivial variations of the
+    same question hit the cache. Its case and inner whitespace are kept, values quoted in the question or in a SQL
+    query are compared exactly. Answers of the agent and of the workflow are cached separately.
+
+    Args:
+        model_name: Name of the LLM model used to answer the query.
+        dataset_id: The dataset the query is run against.
+        schema_hash: Hash of the dataset table schema, see `get_schema_hash`.
+        query: Query provided by the user.
+        use_agent: Whether the query is answered by the agent or by the workflow.
+
+    Returns:
+        SHA-256 hex digest identifying the answer.
+    """
+    key = f'{model_name}|{dataset_id}|{schema_hash}|{use_agent}|{normalize_query(query)}'
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def get_sql_cache_key(model_name: str, table_name: str, schema_hash: str, query: str) -> str:
+    """
+    Build a cache key for a text-to-SQL translation.
+
+    The generated SQL depends on the model, the table and its schema. The query is normalized like for answers and it
+    is not lower-cased either, values quoted in the question end up as case-sensitive SQL literals.
+
+    Args:
+        model_name: Name of the LLM model used to translate the query.
+        table_name: Name of the table the SQL query is run against.
+        schema_hash: Hash of the table schema, see `get_schema_hash`.
+        query: Natural language query.
+
+    Returns:
+        SHA-256 hex digest identifying the translation.
+    """
+    key = f'sql|{model_name}|{table_name}|{schema_hash}|{normalize_query(query)}'
+    return hashlib.sha256(key.encode()).hexdigest()
@@ -1,24 +1,39 @@
+import asyncio
+import functools
 import logging
 import os
-import pathlib
+from collections.abc import Sequence
 from enum import Enum
+from typing import Any
 
+import httpx
+import orjson
 import uvicorn
 from apify import Actor
+from llama_index.core.base.llms.types import ChatMessage, ChatResponse, CompletionResponse
+from llama_index.core.constants import DEFAULT_TEMPERATURE
 from llama_index.llms.openai import OpenAI
+from pydantic import TypeAdapter
 from starlette.applications import Starlette
 from starlette.exceptions import HTTPException
 from starlette.requests import Request
 from starlette.responses import JSONResponse
 from starlette.routing import Route
 
-from .const import HEADERS_READINESS_PROBE
+from ._runtime import get_runtime
+from .const import (
+    HEADERS_READINESS_PROBE,
+    LLM_MAX_CONCURRENCY,
+    UVICORN_BACKLOG,
+    UVICORN_TIMEOUT_KEEP_ALIVE_SECS,
+)
 from .exceptions import DatasetLoadError, WorkflowExecutionError
 from .input_model import DatasetQueryEngine as ActorInput
+from .llm_cache import get_response_cache_key, response_cache
 from .query_agent import run_agent
 from .query_engine import run_workflow
-from .tools import load_dataset
-from .utils import check_inputs
+from .tools import get_table_schema_hash, is_select_query, load_dataset, wait_for_persisted_datasets
+from .utils import check_inputs, run_async
 
 
 class ActorInputStandbyStarts(ActorInput):
@@ -28,47 +43,122 @@ class ActorInputStandbyStarts(ActorInput):
     datasetId: str = ''  # noqa:N815
 
 
+# Validator built once at import (input_model.py is generated, so the adapter lives here)
+ACTOR_INPUT_ADAPTER = TypeAdapter(ActorInput)
+
+
 class ChargeEvent(str, Enum):
     ACTOR_START = 'actor-start'
     QUERY_COMPLETED = 'query-completed'
 
 
-logger = logging.getLogger('apify')
+class ORJSONResponse(JSONResponse):
+    """JSON response serialized with orjson, it is faster than json.dumps and produces bytes directly"""
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content)
+
 
-ACTOR_IS_AT_HOME = Actor.is_at_home()
-STANDBY_MODE = Actor.config.meta_origin == 'STANDBY'
+# Shared by all LLM clients, the limit applies to the whole process regardless of the model
+LLM_SEMAPHORE = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
 
-if ACTOR_IS_AT_HOME:
-    HOST = Actor.config.standby_url if STANDBY_MODE else Actor.config.web_server_url
-    PORT = Actor.config.standby_port if STANDBY_MODE else Actor.config.web_server_port
-else:
-    from dotenv import load_dotenv
 
-    load_dotenv(pathlib.Path(__file__).parent.joinpath('.env').resolve())
-    HOST = 'http://localhost'
-    PORT = 4321
+class ConcurrencyLimitedOpenAI(OpenAI):
+    """OpenAI LLM that waits for a free slot of `LLM_SEMAPHORE` before each async request"""
+
+    # The explicit OpenAI arguments used by the Actor, type checkers would otherwise derive a signature from every
+    # pydantic field, and a catch-all **kwargs would hide misspelled arguments
+    def __init__(
+        self,
+        *,
+        model: str,
+        api_key: str | None,
+        temperature: float = DEFAULT_TEMPERATURE,
+        async_http_client: httpx.AsyncClient | None = None,
+    ) -> None:
+        super().__init__(model=model, temperature=temperature, api_key=api_key, async_http_client=async_http_client)
+
+    async def achat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponse:
+        async with LLM_SEMAPHORE:
+            response: ChatResponse = await super().achat(messages, **kwargs)
+        return response
+
+    async def acomplete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        async with LLM_SEMAPHORE:
+            response: CompletionResponse = await super().acomplete(prompt, formatted, **kwargs)
+        return response
+
+
+logger = logging.getLogger('apify')
 
-ACTOR_URL = f'{HOST}' if ACTOR_IS_AT_HOME else f'{HOST}:{PORT}'
+HOST, PORT, ACTOR_URL, STANDBY_MODE = get_runtime()
+# Read after get_runtime() so that the key from a local .env file is picked up
+OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+STANDBY_PARAMS = {name: field.description for name, field in ActorInput.model_fields.items()}
 STANDBY_MESSAGE = (
     f'Actor is running in standby mode, please provide query params at {ACTOR_URL}, you can use the '
-    f'following params: {ActorInput.model_fields}'
+    f'following params: {STANDBY_PARAMS}'
 )
 
+# Static responses are built (and JSON-encoded) only once and reused for every request
+PROBE_OK_RESPONSE = ORJSONResponse({'status': 'ok'})
+STANDBY_RESPONSE = ORJSONResponse({'message': STANDBY_MESSAGE}, status_code=200)
+
+
+@functools.cache
+def get_openai_http_client() -> httpx.AsyncClient:
+    """Return the HTTP client shared by all OpenAI clients, HTTP/2 sends concurrent requests over one connection"""
+    return httpx.AsyncClient(http2=True)
+
+
+@functools.lru_cache(maxsize=16)
+def get_llm(model: str, api_key: str | None) -> OpenAI:
+    """Return an OpenAI client for the model, clients are reused so that their HTTP connection pool is kept warm"""
+    return ConcurrencyLimitedOpenAI(
+        model=model, temperature=0, api_key=api_key, async_http_client=get_openai_http_client()
+    )
+
 
 async def process_query(actor_input: ActorInput) -> str:
     """Process query, load dataset (if it was not loaded yet) and run workflow (query engine)"""
 
     dataset_id = actor_input.datasetId
     try:
-        table_schema = await load_dataset(dataset_id, refresh_dataset=bool(actor_input.refreshDataset))
-        Actor.log.info(f'Dataset {dataset_id} loaded successfully')
+        table_schema = await load_dataset(
+            dataset_id,
+            refresh_dataset=bool(actor_input.refreshDataset),
+            persist_dataset=bool(actor_input.persistDataset),
+        )
+        logger.info(f'Dataset {dataset_id} loaded successfully')
     except Exception as e:
         msg = f'Error loading dataset {dataset_id} with error: {e}'
         logger.exception(msg)
         raise DatasetLoadError(msg) from e
 
-    llm = OpenAI(model=str(actor_input.modelName), temperature=0, api_key=os.getenv('OPENAI_API_KEY'))
-    if actor_input.useAgent:
+    if actor_input.refreshDataset and (removed := response_cache.invalidate_dataset(dataset_id)):
+        logger.info(f'Dropped {removed} cached answers for dataset {dataset_id}')
+
+    # A SQL query does not need the agent to reason about it, the workflow executes it directly. Only input that
+    # parses as SQL skips the agent, not questions starting with a keyword like "Select the best bars"
+    use_agent = bool(actor_input.useAgent) and not is_select_query(actor_input.query)
+
+    cache_key = None
+    if actor_input.cacheResponses:
+        cache_key = get_response_cache_key(
+            str(actor_input.modelName),
+            dataset_id,
+            get_table_schema_hash(dataset_id, table_schema),
+            actor_input.query,
+            use_agent=use_agent,
+        )
+        cached_answer: str | None = response_cache.get(cache_key)
+        if cached_answer is not None:
+            logger.info(f'Query {actor_input.query} answered from cache')
+            await push_answer(dataset_id, actor_input.query, cached_answer)
+            return cached_answer
+
+    llm = get_llm(str(actor_input.modelName), OPENAI_API_KEY)
+    if use_agent:
         try:
             result = await run_agent(
                 query=actor_input.query,
@@ -95,34 +185,46 @@ async def process_query(actor_input: ActorInput) -> str:
             logger.exception(msg)
             raise WorkflowExecutionError(msg) from e
 
-    await Actor.push_data({'datasetId': dataset_id, 'query': actor_input.query, 'answer': result.response})
+    # Keep only the answer, the full response (tool outputs, sources) is not needed while the data is pushed
+    answer = result.response
+    del result
+
+    if cache_key is not None:
+        response_cache.put(cache_key, answer, dataset_id)
+
+    await push_answer(dataset_id, actor_input.query, answer)
+    return answer
+
+
+async def push_answer(dataset_id: str, query: str, answer: str) -> None:
+    """Store the answer in the default dataset and charge for the query, only once the answer was stored"""
+    await Actor.push_data({'datasetId': dataset_id, 'query': query, 'answer': answer})
     await Actor.charge(ChargeEvent.QUERY_COMPLETED)
-    return result.response
 
 
-async def route_root(request: Request) -> JSONResponse:
+async def route_root(request: Request) -> ORJSONResponse:
     logger.info('Received request at /')
     if request.method != 'GET':
-        return JSONResponse({'message': f'Method: {request.method} not allowed'}, status_code=405)
+        return ORJSONResponse({'message': f'Method: {request.method} not allowed'}, status_code=405)
 
-    if str(request.headers.get(HEADERS_READINESS_PROBE)) == '1':
+    if request.headers.get(HEADERS_READINESS_PROBE) == '1':
         logger.debug('Received readiness probe')
-        return JSONResponse({'status': 'ok'})
+        return PROBE_OK_RESPONSE
 
-    query_params = dict(request.query_params.items())
-    query_params.pop('token', None)
     if request.query_params:
+        query_params = dict(request.query_params.items())
+        query_params.pop('token', None)
         try:
-            actor_input = ActorInput(**query_params)  # type:ignore[arg-type]
+            actor_input = ACTOR_INPUT_ADAPTER.validate_python(query_params)
             result = await process_query(actor_input)
             logger.info(f'Query {actor_input.query} processed successfully, result: {result}')
-            return JSONResponse({'message': result})
+            return ORJSONResponse({'message': result})
         except Exception as e:
             msg = f'Failed to process request, error: {e}'
             logger.exception(msg)
             raise HTTPException(status_code=400, detail=msg) from e
 
-    return JSONResponse({'message': STANDBY_MESSAGE}, status_code=200)
+    return STANDBY_RESPONSE
 
 
 app = Starlette(
@@ -135,13 +237,21 @@ app = Starlette(
 
 async def start_server() -> None:
     logger.info(f'Starting the HTTP server at {ACTOR_URL}')
-    config = uvicorn.Config(app, host='0.0.0.0', port=PORT)  # noqa: S104
+    # Large backlog so that connection bursts are not refused. There is no concurrency limit, uvicorn would answer
+    # 503 over it to readiness probes too, the expensive part (LLM calls) is throttled by LLM_SEMAPHORE instead
+    config = uvicorn.Config(
+        app,
+        host='0.0.0.0',  # noqa: S104
+        port=PORT,
+        backlog=UVICORN_BACKLOG,
+        timeout_keep_alive=UVICORN_TIMEOUT_KEEP_ALIVE_SECS,
+    )
     server = uvicorn.Server(config)
     await server.serve()
 
 
 async def check_openai_api_key() -> None:
-    if not os.getenv('OPENAI_API_KEY'):
+    if not OPENAI_API_KEY:
         await Actor.fail(status_message='OPENAI_API_KEY is not set. Please contact Actor developer.')
 
 
@@ -157,15 +267,17 @@ async def main() -> None:
                 if not (payload := await Actor.get_input()):
                     await Actor.fail(status_message='Actor input was not provided')
                     return
+                if not isinstance(payload, dict):
+                    await Actor.fail(status_message='Actor input must be a JSON object')
+                    return
 
-                actor_input = ActorInput(**payload)
+                actor_input = ACTOR_INPUT_ADAPTER.validate_python(payload)
                 actor_input = await check_inputs(actor_input, payload)
                 await process_query(actor_input)
+                await wait_for_persisted_datasets()
             except Exception as e:
                 await Actor.fail(status_message='Failed to process query', exception=e)
 
 
 if __name__ == '__main__':
-    import asyncio
-
-    asyncio.run(main())
+    run_async(main())
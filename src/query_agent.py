@@ -1,22 +1,36 @@
+import functools
 import logging
 from typing import Any
 
-from llama_index.core.agent import ReActAgent
+from llama_index.core.agent import AgentRunner, ReActAgentWorker, ReActChatFormatter
+from llama_index.core.agent.react.prompts import CONTEXT_REACT_CHAT_SYSTEM_HEADER
 from llama_index.core.chat_engine.types import AgentChatResponse
+from llama_index.core.memory import ChatMemoryBuffer
 from llama_index.core.tools import FunctionTool
 from llama_index.llms.openai import OpenAI
 
-from .tools import LLMRegistry, execute_sql, is_query_sql, synthesize_results, user_query_to_sql
-
-determine_query_tool = FunctionTool.from_defaults(fn=is_query_sql)
-user_query_to_sql_tool = FunctionTool.from_defaults(fn=user_query_to_sql)
-execute_sql_tool = FunctionTool.from_defaults(fn=execute_sql)
-results_synthesize_tool = FunctionTool.from_defaults(fn=synthesize_results)
+from .const import AGENT_WORKER_CACHE_MAX_SIZE
+from .llm_cache import LRUCache
+from .tools import LLMRegistry, execute_sql, is_select_query, synthesize_results, user_query_to_sql
 
+# Agent workers hold only the tools, the LLM and the system prompt, the conversation state lives in the AgentRunner
+# memory, so a worker can be shared by all requests against the same dataset
+agent_workers = LRUCache(maxsize=AGENT_WORKER_CACHE_MAX_SIZE)
 
 logger = logging.getLogger('apify')
 
 
+@functools.cache
+def get_agent_tools() -> list[FunctionTool]:
+    """Build the agent tools on first use, FunctionTool introspects the function signatures, so do it only once"""
+    return [
+        FunctionTool.from_defaults(fn=is_select_query),
+        FunctionTool.from_defaults(fn=user_query_to_sql),
+        FunctionTool.from_defaults(fn=execute_sql),
+        FunctionTool.from_defaults(fn=synthesize_results),
+    ]
+
+
 async def run_agent(
     query: str, table_name: str, table_schema: dict[str, Any], llm: OpenAI, verbose: bool = False
 ) -> AgentChatResponse:
@@ -42,20 +56,41 @@ async def run_agent(
 
     context = f'Table name provided by user: {table_name}. Table schema: {table_schema}'
 
-    # Initialize the ReAct Agent with the Tools (LLM not pre-instantiated)
-    agent = ReActAgent.from_tools(
-        [
-            determine_query_tool,
-            user_query_to_sql_tool,
-            execute_sql_tool,
-            results_synthesize_tool,
-        ],
+    # Fresh memory for every request, the (stateless) worker is reused
+    agent = AgentRunner(
+        get_agent_worker(llm, table_name, context, verbose=verbose),
+        memory=ChatMemoryBuffer.from_defaults(llm=llm),
         llm=llm,
         verbose=verbose,
-        allow_parallel_tool_calls=False,
-        context=context,
     )
 
     response: AgentChatResponse = await agent.achat(query)
     logger.info(f'Agent answer: {response.response}')
     return response
+
+
+def get_agent_worker(llm: OpenAI, table_name: str, context: str, *, verbose: bool = False) -> ReActAgentWorker:
+    """
+    Return a ReAct agent worker for the given LLM and context, build it only if it is not cached yet.
+
+    Args:
+        llm: The language model used by the agent.
+        table_name: The name of the table the worker is built for.
+        context: Context (table name and schema) placed into the agent's system prompt.
+        verbose: Flag to enable verbose logging.
+
+    Returns:
+        ReActAgentWorker with the query engine tools.
+    """
+    key = f'{llm.model}|{llm.api_key}|{verbose}|{context}'
+    if (worker := agent_workers.get(key)) is None:
+        worker = ReActAgentWorker.from_tools(
+            get_agent_tools(),
+            llm=llm,
+            verbose=verbose,
+            react_chat_formatter=ReActChatFormatter.from_defaults(
+                system_header=CONTEXT_REACT_CHAT_SYSTEM_HEADER, context=context
+            ),
+        )
+        agent_workers.put(key, worker, table_name)
+    return worker
@@ -1,13 +1,21 @@
+import asyncio
 import logging
+import re
 from typing import Any
 
 from llama_index.core.workflow import Context, Event, StartEvent, StopEvent, Workflow, step
 from llama_index.llms.openai import OpenAI
 
-from .tools import LLMRegistry, execute_sql, is_query_sql, synthesize_results, user_query_to_sql
+from .tools import LLMRegistry, execute_sql, is_select_query, synthesize_results, user_query_to_sql
+from .utils import quote_identifier
 
 logger = logging.getLogger('apify')
 
+# SQL queries refer to the table as `dataset`, match it as a whole word only (not inside e.g. `datasetId`)
+# and in any case (identifiers are case-insensitive) and replace it with the quoted table name, dataset IDs may start
+# with a digit
+DATASET_TABLE_PATTERN = re.compile(r'\bdataset\b', re.IGNORECASE)
+
 
 class DatasetAnalyzerEvent(Event):
     """
@@ -48,16 +56,16 @@ class DatasetAnalyzeQueryEngineWorkflow(Workflow):
         table_name = ev.get('table_name')
         table_schema = ev.get('table_schema')
 
-        await ctx.set('llm', llm)
-        await ctx.set('query', ev.get('query'))
-        await ctx.set('table_name', ev.get('table_name'))
-        await ctx.set('table_schema', ev.get('table_schema'))
+        # Stored under a single key, every ctx.set/get call takes the context lock
+        await ctx.set('state', {'query': query, 'table_name': table_name, 'table_schema': table_schema})
 
         LLMRegistry.set(llm)
 
-        if is_query_sql(query):
-            sql_query = query.replace('dataset', table_name)
-            results = execute_sql(sql_query)
+        if is_select_query(query):
+            # A callable replacement, the quoted name is inserted as is (no backslash or group processing)
+            quoted_table_name = quote_identifier(table_name)
+            sql_query = DATASET_TABLE_PATTERN.sub(lambda _: quoted_table_name, query)
+            results = await asyncio.to_thread(execute_sql, sql_query)
             return SynthesizeEvent(sql_query=sql_query, table_schema=table_schema, results=results)
 
         return DatasetAnalyzerEvent(query=query, table_schema=table_schema)
@@ -78,13 +86,13 @@ class DatasetAnalyzeQueryEngineWorkflow(Workflow):
             SynthesizeEvent: An event containing the executed SQL query, the table schema
                 used, and the results of the query.
         """
-        table_name = await ctx.get('table_name', default=None)
-        table_schema = await ctx.get('table_schema', default=None)
+        state = await ctx.get('state')
+        table_name, table_schema = state['table_name'], state['table_schema']
 
         query = ev.query
 
         sql_query = await user_query_to_sql(query, table_name, table_schema)
-        results = execute_sql(sql_query)
+        results = await asyncio.to_thread(execute_sql, sql_query)
         return SynthesizeEvent(sql_query=sql_query, table_schema=table_schema, results=results)
 
     @step
@@ -99,8 +107,9 @@ class DatasetAnalyzeQueryEngineWorkflow(Workflow):
         Returns:
             StopEvent: An event containing the synthesized result.
         """
-        query = await ctx.get('query', default=None)
-        response = synthesize_results(query, ev.sql_query, ev.results, ev.table_schema)
+        state = await ctx.get('state')
+        query = state['query']
+        response = await synthesize_results(query, ev.sql_query, ev.results, ev.table_schema)
         logger.info(f'Workflow answer: {response.response}')
         return StopEvent(result=response)
 
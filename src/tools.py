@@ -1,25 +1,76 @@
+import asyncio
+import functools
+import hashlib
 import logging
-import re
-from typing import Any
+import pathlib
+import tempfile
+import threading
+from collections import defaultdict
+from collections.abc import Hashable
+from datetime import datetime
+from typing import Any, NamedTuple
 
 import duckdb
-import polars as pl
-import sqlite_utils
+import orjson
+from apify import Actor
 from apify_client import ApifyClientAsync
-from llama_index.core import QueryBundle, Response
-from llama_index.core.indices.struct_store.sql_retriever import DefaultSQLParser
+from llama_index.core import PromptTemplate, Response
 from llama_index.llms.openai import OpenAI
 
-from .const import DEFAULT_DATASET_PROMPT, DEFAULT_RESPONSE_SYNTHESIS_PROMPT
-from .utils import get_python_type
-
-# Constant for detecting starting SQL keywords, with typical commands such as SELECT, INSERT, etc.
-SQL_QUERY_PATTERN = re.compile(r'^\s*(SELECT|INSERT|UPDATE|DELETE|WITH|CREATE|DROP|ALTER)\b', re.IGNORECASE)
-DROP_TABLE_QUERY = 'DROP TABLE IF EXISTS {table_name};'
-SHOW_TABLES_QUERY = 'SHOW TABLES;'
+from .batcher import MicroBatcher
+from .const import (
+    DATASET_CACHE_MAX_BYTES,
+    DATASET_CACHE_STORE_NAME,
+    DATASET_PAGE_CONCURRENCY,
+    DATASET_PAGE_SIZE,
+    DEFAULT_DATASET_BATCH_PROMPT,
+    DEFAULT_DATASET_PROMPT,
+    DEFAULT_RESPONSE_SYNTHESIS_PROMPT,
+    PROMPT_CACHE_MAX_SIZE,
+    SQL_CACHE_MAX_SIZE,
+    SQL_RESULT_MAX_ROWS,
+    TEXT_TO_SQL_BATCH_MAX_SIZE,
+    TEXT_TO_SQL_BATCH_WAIT_SECS,
+)
+from .llm_cache import LRUCache, get_schema_hash, get_sql_cache_key, sql_cache
+from .utils import format_sql_response, format_table_schema, get_python_type, quote_identifier
+
+CREATE_TABLE_FROM_JSON_QUERY = (
+    'CREATE OR REPLACE TABLE {table_name} AS SELECT * FROM '
+    "read_json_auto(?, format='newline_delimited', sample_size=-1, union_by_name=true);"
+)
+CREATE_TABLE_FROM_PARQUET_QUERY = 'CREATE OR REPLACE TABLE {table_name} AS SELECT * FROM read_parquet(?);'
+# Only the column names and types of the table, the table name is bound as a parameter instead of being quoted
+TABLE_COLUMNS_QUERY = 'SELECT column_name, data_type FROM duckdb_columns() WHERE table_name = ? ORDER BY column_index;'
+COPY_TABLE_TO_PARQUET_QUERY = "COPY {table_name} TO '{path}' (FORMAT PARQUET);"
+SQL_RESULT_TRUNCATED_NOTE = '\n(The SQL response may be truncated, only its first {max_rows} rows are shown.)'
+# Syntax tree of a SELECT statement as JSON, the statement is only parsed, not planned
+SERIALIZE_SQL_QUERY = 'SELECT json_serialize_sql(?::VARCHAR);'
+TABLE_NAMES_QUERY = 'SELECT table_name FROM duckdb_tables();'
+# Table functions which do not read files, e.g. unnest of a list column, every other one (read_csv, glob) is rejected
+ALLOWED_TABLE_FUNCTIONS = frozenset({'unnest', 'range', 'generate_series'})
+# OpenAI JSON mode, the text-to-SQL prompts ask for an object with the SQL under the `sql` key
+JSON_RESPONSE_FORMAT = {'type': 'json_object'}
 
 logger = logging.getLogger('apify')
 
+# Table schema of every dataset loaded into DuckDB, a schema does not change until its dataset is refreshed
+_schema_cache: dict[str, dict[str, Any]] = {}
+# Hash of every schema in `_schema_cache`, it is part of the cache keys, so it is computed only once per load
+_schema_hashes: dict[str, str] = {}
+# Text-to-SQL prompts with the table name and schema filled in, keyed by both, only the question varies
+_prompt_cache = LRUCache(maxsize=PROMPT_CACHE_MAX_SIZE)
+# Translated SQL queries that have not been executed yet, keyed by the SQL, only the ones that run are cached
+_unverified_sql = LRUCache(maxsize=SQL_CACHE_MAX_SIZE)
+# In-memory database with one table per loaded dataset
+_db = duckdb.connect()
+# A DuckDB connection must not be shared by threads, each thread queries the database through its own cursor
+_thread_local = threading.local()
+# One lock per dataset, concurrent requests for the same dataset load it only once
+_dataset_locks: defaultdict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+# Uploads of persisted datasets running in the background, referenced so that they are not garbage collected
+_persist_tasks: set[asyncio.Task] = set()
+
 
 class LLMRegistry:
     _llm: OpenAI | None = None
@@ -35,58 +86,243 @@ class LLMRegistry:
         cls._llm = new_llm
 
 
-async def load_dataset(dataset_id: str, *, refresh_dataset: bool = False) -> dict[str, Any]:
+async def load_dataset(
+    dataset_id: str, *, refresh_dataset: bool = False, persist_dataset: bool = False
+) -> dict[str, Any]:
     """
     Load a dataset into DuckDB after fetching it from Apify.
 
     If the dataset already exists in the DuckDB in-memory tables and `refresh_dataset` is set to False,
-    it skips the loading process.
+    it skips the loading process and returns the memoized table schema. Concurrent calls for the same dataset
+    wait for a single load instead of fetching the dataset in parallel.
 
     Args:
         dataset_id: The unique identifier of the dataset to be loaded.
         refresh_dataset: A flag to indicate if the dataset should be reloaded.
+        persist_dataset: A flag to restore the dataset from, and save it to, a named key-value store.
 
     Returns:
         table_schema: A dictionary representing the structure of the dataset table
     """
-    existing_tables = duckdb.sql(SHOW_TABLES_QUERY)
-    dataset_exists = dataset_id in str(existing_tables)
+    async with _dataset_locks[dataset_id]:
+        if not refresh_dataset and (table_schema := _schema_cache.get(dataset_id)) is not None:
+            logger.info(f'Dataset {dataset_id} already loaded')
+            return table_schema
+
+        # Forget the old schema first, so that a failed refresh is retried by the next call
+        _schema_cache.pop(dataset_id, None)
+        _schema_hashes.pop(dataset_id, None)
+        _prompt_cache.invalidate_dataset(dataset_id)
+        # A translation that ran against the old data may fail against the new one (e.g. a cast of a changed value)
+        sql_cache.invalidate_dataset(dataset_id)
+        _unverified_sql.invalidate_dataset(dataset_id)
+        table_schema = await _load_dataset_table(
+            dataset_id, refresh_dataset=refresh_dataset, persist_dataset=persist_dataset
+        )
+        _schema_hashes[dataset_id] = get_schema_hash(table_schema)
+        _schema_cache[dataset_id] = table_schema
+        return table_schema
+
+
+def get_table_schema_hash(table_name: str, table_schema: dict[str, Any]) -> str:
+    """Return the hash of the table schema, it is memoized for the schema returned by `load_dataset`"""
+    # The agent passes the table name and schema on its own, only the loaded schema object itself is memoized
+    if _schema_cache.get(table_name) is table_schema:
+        return _schema_hashes[table_name]
+    return get_schema_hash(table_schema)
+
+
+async def _load_dataset_table(
+    dataset_id: str, *, refresh_dataset: bool = False, persist_dataset: bool = False
+) -> dict[str, Any]:
+    """Fetch the dataset into a DuckDB table (replacing an existing one) and return its table schema"""
+    await _fetch_dataset(dataset_id, refresh_dataset=refresh_dataset, persist_dataset=persist_dataset)
+    logger.info(f'Dataset {dataset_id} loaded successfully')
+
+    # Get the table schema in the format: VARCHAR, INT, etc.
+    sql_schema = _get_cursor().execute(TABLE_COLUMNS_QUERY, [dataset_id]).fetchall()
+    # convert the SQL schema to a dictionary of column names and python types (for pydantic validation)
+    return {col_name: get_python_type(sql_type) for col_name, sql_type in sql_schema}
+
+
+def _get_cursor() -> duckdb.DuckDBPyConnection:
+    """Return the DuckDB cursor of the current thread, all cursors share the tables of the in-memory database"""
+    if (cursor := getattr(_thread_local, 'cursor', None)) is None:
+        cursor = _thread_local.cursor = _db.cursor()
+    return cursor
+
+
+def _create_table_from_json(table_name: str, paths: list[pathlib.Path]) -> None:
+    """Parse JSON Lines files into a DuckDB table, replacing the previous version of the table"""
+    query = CREATE_TABLE_FROM_JSON_QUERY.format(table_name=quote_identifier(table_name))
+    _get_cursor().execute(query, [[str(path) for path in paths]])
+
+
+def _create_table_from_parquet(table_name: str, path: pathlib.Path) -> None:
+    """Load a Parquet file into a DuckDB table, replacing the previous version of the table"""
+    _get_cursor().execute(CREATE_TABLE_FROM_PARQUET_QUERY.format(table_name=quote_identifier(table_name)), [str(path)])
+
+
+def _export_table_to_parquet(table_name: str, path: pathlib.Path) -> bytes:
+    _get_cursor().execute(COPY_TABLE_TO_PARQUET_QUERY.format(table_name=quote_identifier(table_name), path=path))
+    return path.read_bytes()
 
-    if refresh_dataset or not dataset_exists:
-        client = ApifyClientAsync()
-        items = await client.dataset(dataset_id).get_items_as_bytes()
-        dataset = pl.read_json(items)
 
-        if dataset_exists:
-            duckdb.sql(DROP_TABLE_QUERY.format(table_name=dataset_id))
+@functools.cache
+def get_apify_client() -> ApifyClientAsync:
+    """Return the Apify API client, it is created once so that its HTTP connection pool is reused across loads"""
+    return ApifyClientAsync()
 
-        duckdb.register(dataset_id, dataset)
-        logger.info(f'Dataset {dataset_id} loaded successfully')
+
+async def _fetch_dataset(dataset_id: str, *, refresh_dataset: bool = False, persist_dataset: bool = False) -> None:
+    """
+    Fetch dataset items from Apify into a DuckDB table.
+
+    The items are downloaded as JSON Lines into temporary files and parsed by DuckDB's JSON reader straight into
+    the table. With `persist_dataset`, a Parquet copy of the table is uploaded in the background to a named
+    key-value store under a stable per-dataset key, together with the dataset's `modifiedAt`, so a restarted Actor
+    restores an unchanged dataset from one record instead of downloading all items again. `refresh_dataset` skips
+    the persisted copy.
+    """
+    client = get_apify_client()
+    dataset_info = await client.dataset(dataset_id).get() or {}
+    persisted = _get_persisted_dataset(dataset_id, dataset_info) if persist_dataset else None
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        work_dir = pathlib.Path(tmp_dir)
+        if persisted and not refresh_dataset and await _restore_persisted_dataset(persisted, dataset_id, work_dir):
+            logger.info(f'Dataset {dataset_id} restored from the key-value store')
+            return
+
+        paths = await _download_dataset_items(client, dataset_id, dataset_info.get('itemCount') or 0, work_dir)
+        if not paths:
+            raise ValueError(f'Dataset {dataset_id} has no items')
+        await asyncio.to_thread(_create_table_from_json, dataset_id, paths)
+
+    if persisted:
+        # The upload does not delay the query which loaded the dataset
+        task = asyncio.create_task(_persist_dataset(persisted, dataset_id))
+        _persist_tasks.add(task)
+        task.add_done_callback(_persist_tasks.discard)
+
+
+async def _download_dataset_items(
+    client: ApifyClientAsync, dataset_id: str, item_count: int, work_dir: pathlib.Path
+) -> list[pathlib.Path]:
+    """
+    Download dataset items as JSON Lines files, return the paths of the non-empty files in the dataset order.
+
+    Datasets larger than `DATASET_PAGE_SIZE` are downloaded in pages fetched concurrently and each page is written
+    to its own file as soon as it arrives, so the raw JSON of the whole dataset is never held in memory at once.
+    """
+    dataset_client = client.dataset(dataset_id)
+    semaphore = asyncio.Semaphore(DATASET_PAGE_CONCURRENCY)
+
+    async def fetch_page(index: int, offset: int | None, limit: int | None) -> pathlib.Path:
+        async with semaphore:
+            items = await dataset_client.get_items_as_bytes(item_format='jsonl', offset=offset, limit=limit)
+        path = work_dir / f'page-{index:06d}.jsonl'
+        await asyncio.to_thread(path.write_bytes, items)
+        return path
+
+    if item_count <= DATASET_PAGE_SIZE:
+        paths = [await fetch_page(0, None, None)]
     else:
-        logger.info(f'Dataset {dataset_id} already loaded')
+        offsets = range(0, item_count, DATASET_PAGE_SIZE)
+        # A task group cancels the other downloads when one fails, before the temporary directory is removed
+        try:
+            async with asyncio.TaskGroup() as task_group:
+                tasks = [
+                    task_group.create_task(fetch_page(i, offset, DATASET_PAGE_SIZE)) for i, offset in enumerate(offsets)
+                ]
+        except ExceptionGroup as e:
+            # Report the failed download itself, not the group wrapping it
+            raise e.exceptions[0] from e
+        paths = [task.result() for task in tasks]
+        logger.debug(f'Dataset {dataset_id} downloaded in {len(paths)} pages')
 
-    # Get the table schema in the formatL VARCHAR, INT, etc.
-    sql_schema = duckdb.sql(f'DESCRIBE {dataset_id}').fetchall()
-    # convert the SQL schema to a dictionary of column names and python types (for pydantic validation)
-    table_schema = {}
-    for col in sql_schema:
-        col_name, sql_type = col[0], col[1]
-        table_schema[col_name] = get_python_type(sql_type)
+    return [path for path in paths if path.stat().st_size]
+
+
+class PersistedDataset(NamedTuple):
+    """Key-value store record with the Parquet copy of a dataset and the dataset version the copy was made from"""
 
-    return table_schema
+    key: str
+    version: str
 
+    @property
+    def version_key(self) -> str:
+        return f'{self.key}-version'
 
-def is_query_sql(query: str) -> bool:
+
+def _get_persisted_dataset(dataset_id: str, dataset_info: dict[str, Any]) -> PersistedDataset | None:
+    """Return where the dataset is persisted, the key stays the same when the dataset is modified"""
+    if not isinstance(modified_at := dataset_info.get('modifiedAt'), datetime):
+        return None
+    # Dataset IDs such as `username~name` are not valid record keys, a hash of the ID always is
+    key = f'dataset-{hashlib.sha256(dataset_id.encode()).hexdigest()}'
+    return PersistedDataset(key, modified_at.isoformat())
+
+
+async def _restore_persisted_dataset(persisted: PersistedDataset, table_name: str, work_dir: pathlib.Path) -> bool:
+    # The persisted copy is only an optimization, failing to read it must not fail the dataset load
+    try:
+        store = await Actor.open_key_value_store(name=DATASET_CACHE_STORE_NAME)
+        if await store.get_value(persisted.version_key) != persisted.version:
+            return False
+        if (value := await store.get_value(persisted.key)) is None:
+            return False
+        path = work_dir / 'persisted.parquet'
+        await asyncio.to_thread(path.write_bytes, value)
+        await asyncio.to_thread(_create_table_from_parquet, table_name, path)
+    except Exception as e:
+        logger.warning(f'Failed to read persisted dataset {table_name}: {e}')
+        return False
+    return True
+
+
+async def _persist_dataset(persisted: PersistedDataset, table_name: str) -> None:
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = pathlib.Path(tmp_dir) / 'export.parquet'
+            value = await asyncio.to_thread(_export_table_to_parquet, table_name, path)
+        store = await Actor.open_key_value_store(name=DATASET_CACHE_STORE_NAME)
+        if len(value) > DATASET_CACHE_MAX_BYTES:
+            logger.info(f'Dataset {table_name} is too large to be persisted in the key-value store')
+            # A copy of an older, smaller version of the dataset would never be restored again
+            if await store.get_value(persisted.version_key) is not None:
+                await store.set_value(persisted.version_key, None)
+                await store.set_value(persisted.key, None)
+            return
+        # The copy is overwritten in place, the version is written last so that a partial update is never restored
+        await store.set_value(persisted.key, value, content_type='application/octet-stream')
+        await store.set_value(persisted.version_key, persisted.version, content_type='text/plain')
+    except Exception as e:
+        logger.warning(f'Failed to persist dataset {table_name}: {e}')
+
+
+async def wait_for_persisted_datasets() -> None:
+    """Wait until the datasets being persisted in the background are uploaded, before the Actor exits"""
+    await asyncio.gather(*_persist_tasks)
+
+
+def is_select_query(query: str) -> bool:
     """
-    Determine whether the given string is a SQL query based on common SQL keywords.
+    Determine whether the given string is a SQL query, it must parse as a single SELECT statement.
+
+    Questions starting with a keyword, e.g. "Select the best bars", do not parse and are not SQL queries.
 
     Args:
         query (str): String to evaluate
 
     Returns:
-        bool: True if the string is a SQL query, False otherwise.
+        bool: True if the string is a SELECT query, False otherwise.
     """
-    return bool(SQL_QUERY_PATTERN.match(query))
+    try:
+        statements = _get_cursor().extract_statements(query)
+    except duckdb.Error:
+        return False
+    return len(statements) == 1 and statements[0].type == duckdb.StatementType.SELECT
 
 
 async def user_query_to_sql(query: str, table_name: str, table_schema: dict[str, Any]) -> str:
@@ -103,22 +339,122 @@ async def user_query_to_sql(query: str, table_name: str, table_schema: dict[str,
         A string containing the SQL query interpreted from the input parameters.
     """
     llm = LLMRegistry.get()
-    prompt = DEFAULT_DATASET_PROMPT
+    # The LLM runs with temperature 0, the same question about the same schema is translated only once
+    schema_hash = get_table_schema_hash(table_name, table_schema)
+    cache_key = get_sql_cache_key(llm.model, table_name, schema_hash, query)
+    sql_query: str | None = sql_cache.get(cache_key)
+    if sql_query is not None:
+        logger.debug(f'SQL for query {query} served from cache')
+        return sql_query
+
+    # Concurrent queries against the same table and model are translated in a single LLM call
+    key = (llm.model, table_name, schema_hash)
+    sql_query = await text_to_sql_batcher.submit(key, TextToSQLItem(query, table_name, table_schema, schema_hash, llm))
+    # Cached by execute_sql once the query runs, a wrong translation must not be served again
+    _unverified_sql.put(sql_query, cache_key, table_name)
+    return sql_query
+
+
+class DatasetPrompts(NamedTuple):
+    text_to_sql: PromptTemplate
+    text_to_sql_batch: PromptTemplate
+
+
+def _get_dataset_prompts(table_name: str, table_schema: dict[str, Any], schema_hash: str) -> DatasetPrompts:
+    """Return the text-to-SQL prompts for the table, the schema is rendered only once per table and schema"""
+    # The agent passes the table name and schema on its own, a different schema must not reuse a cached prompt
+    cache_key = f'{table_name}|{schema_hash}'
+    prompts: DatasetPrompts | None = _prompt_cache.get(cache_key)
+    if prompts is None:
+        prompt_args = {'table_name': table_name, 'table_schema': format_table_schema(table_schema)}
+        prompts = DatasetPrompts(
+            DEFAULT_DATASET_PROMPT.partial_format(**prompt_args),
+            DEFAULT_DATASET_BATCH_PROMPT.partial_format(**prompt_args),
+        )
+        _prompt_cache.put(cache_key, prompts, table_name)
+    return prompts
+
+
+class TextToSQLItem(NamedTuple):
+    query: str
+    table_name: str
+    table_schema: dict[str, Any]
+    schema_hash: str
+    llm: OpenAI
+
+
+async def _predict_sql(llm: OpenAI, prompt: PromptTemplate, **prompt_args: Any) -> Any:
+    """Run a text-to-SQL prompt in OpenAI JSON mode and return the decoded `sql` value"""
+    messages = prompt.format_messages(llm=llm, **prompt_args)
+    response = await llm.achat(messages, response_format=JSON_RESPONSE_FORMAT)
+    return orjson.loads(response.message.content or '')['sql']
+
+
+async def _text_to_sql(_: Hashable, item: TextToSQLItem) -> str:
+    """Translate a single query to SQL"""
     # Get the SQL query with text-to-SQL prompt, provide table name and schema to ensure correctness
-    response_str = await llm.apredict(
-        prompt=prompt,
-        table_name=table_name,
-        table_schema=table_schema,
-        question=query,
+    try:
+        prompt = _get_dataset_prompts(item.table_name, item.table_schema, item.schema_hash).text_to_sql
+        sql_query = _check_sql(await _predict_sql(item.llm, prompt, question=item.query))
+    except (orjson.JSONDecodeError, KeyError, TypeError) as e:
+        raise ValueError(f'Failed to parse SQL query generated for: {item.query}') from e
+    return sql_query
+
+
+def _check_sql(sql_query: Any) -> str:
+    """Return the stripped SQL query, JSON mode guarantees valid JSON but not that the `sql` value is a string"""
+    if not isinstance(sql_query, str):
+        raise TypeError(f'The generated SQL query is not a string: {sql_query!r}')
+    return sql_query.strip()
+
+
+async def _text_to_sql_batch(key: Hashable, items: list[TextToSQLItem]) -> list[str]:
+    """Translate several queries against the same table to SQL with a single LLM call"""
+    first = items[0]
+    # Each question is a JSON string, so its text cannot pose as another numbered question
+    questions = '\n'.join(
+        orjson.dumps({'n': i, 'question': item.query}).decode() for i, item in enumerate(items, start=1)
     )
-    sql_parser = DefaultSQLParser()
-    return sql_parser.parse_response_to_sql(response_str, QueryBundle(query_str=query))
+    try:
+        prompt = _get_dataset_prompts(first.table_name, first.table_schema, first.schema_hash).text_to_sql_batch
+        sql_queries = _match_batched_sql(await _predict_sql(first.llm, prompt, questions=questions), len(items))
+    except (orjson.JSONDecodeError, KeyError, TypeError):
+        sql_queries = None
+
+    if sql_queries is None:
+        logger.warning(f'Failed to parse batched SQL queries, translating {len(items)} queries one by one')
+        return list(await asyncio.gather(*(_text_to_sql(key, item) for item in items)))
+
+    return sql_queries
+
+
+def _match_batched_sql(entries: Any, count: int) -> list[str] | None:
+    """Order the batched SQL queries by their question numbers, return None unless every question has exactly one"""
+    if not isinstance(entries, list) or len(entries) != count:
+        return None
+    sql_by_number = {entry['n']: entry['sql'] for entry in entries}
+    if set(sql_by_number) != set(range(1, count + 1)) or not all(isinstance(v, str) for v in sql_by_number.values()):
+        return None
+    return [sql_by_number[n].strip() for n in range(1, count + 1)]
+
+
+text_to_sql_batcher: MicroBatcher[Hashable, TextToSQLItem, str] = MicroBatcher(
+    _text_to_sql,
+    _text_to_sql_batch,
+    max_batch_size=TEXT_TO_SQL_BATCH_MAX_SIZE,
+    max_wait_secs=TEXT_TO_SQL_BATCH_WAIT_SECS,
+)
 
 
 def execute_sql(sql_query: str) -> list[dict[str, Any]] | Any:
     """
     Executes an SQL query and returns the result.
 
+    Only a single read-only SELECT statement reading the loaded tables is executed. Other statements, and
+    statements reading files (through table functions such as read_csv or file paths used as tables), are rejected.
+    At most `SQL_RESULT_MAX_ROWS` rows are returned, the result is converted to Python objects by Arrow without
+    going through a pandas DataFrame.
+
     Args:
         sql_query (str): The SQL query string to be executed.
 
@@ -126,14 +462,74 @@ def execute_sql(sql_query: str) -> list[dict[str, Any]] | Any:
         list[dict[str,Any]]: The result of the executed query as a list of dictionaries
     """
 
+    cursor = _get_cursor()
     try:
-        return duckdb.sql(sql_query).df().to_dict(orient='records')
-    except sqlite_utils.utils.sqlite3.OperationalError as exc:
+        # The statements are only parsed here, anything other than a single SELECT is rejected before it is planned
+        statements = cursor.extract_statements(sql_query)
+        is_select = len(statements) == 1 and statements[0].type == duckdb.StatementType.SELECT
+        forbidden_reference = _find_forbidden_table_reference(cursor, sql_query) if is_select else None
+        # The query runs only when the result is materialized, runtime errors (e.g. a failed cast) are raised here
+        if is_select and forbidden_reference is None:
+            rows = cursor.sql(sql_query).limit(SQL_RESULT_MAX_ROWS).arrow().to_pylist()
+    except duckdb.Error as exc:
+        _unverified_sql.pop(sql_query)
         logger.exception(f'Error executing query: {sql_query}')
-        raise ValueError('Invalid query') from exc
-
-
-def synthesize_results(
+        # Keep the DuckDB message, the agent uses it to correct the query
+        raise ValueError(f'Invalid query: {exc}') from exc
+
+    # Tables are shared by all requests, a generated (or user provided) query must not modify or drop them
+    if not is_select:
+        _unverified_sql.pop(sql_query)
+        raise ValueError(f'Invalid query, only a single SELECT statement can be executed: {sql_query}')
+    # The files of the container (or any URL) must not be readable through a query either
+    if forbidden_reference is not None:
+        _unverified_sql.pop(sql_query)
+        raise ValueError(
+            f'Invalid query, only the dataset table can be queried, not {forbidden_reference}: {sql_query}'
+        )
+
+    # The query was translated by user_query_to_sql and it runs, so the translation can be reused
+    if (entry := _unverified_sql.pop(sql_query)) is not None:
+        table_name, cache_key = entry
+        sql_cache.put(cache_key, sql_query, table_name)
+    return rows
+
+
+def _find_forbidden_table_reference(cursor: duckdb.DuckDBPyConnection, sql_query: str) -> str | None:
+    """Return the first table function or table of the SELECT query that is not a loaded table, None if there is none"""
+    [(serialized_json,)] = cursor.execute(SERIALIZE_SQL_QUERY, [sql_query]).fetchall()
+    serialized = orjson.loads(serialized_json)
+    if serialized['error']:
+        return 'a statement which cannot be checked'
+
+    table_names: set[str] = set()
+    cte_names: set[str] = set()
+    nodes: list[Any] = [serialized['statements']]
+    while nodes:
+        node = nodes.pop()
+        if isinstance(node, list):
+            nodes.extend(node)
+            continue
+        if not isinstance(node, dict):
+            continue
+        nodes.extend(node.values())
+        if node.get('type') == 'TABLE_FUNCTION':
+            if (function_name := node['function']['function_name']) not in ALLOWED_TABLE_FUNCTIONS:
+                return f'the table function {function_name}'
+        elif node.get('type') in ('BASE_TABLE', 'SHOW_REF') and node.get('table_name'):
+            table_names.add(node['table_name'])
+        if isinstance(cte_map := node.get('cte_map'), dict):
+            cte_names.update(entry['key'] for entry in cte_map['map'])
+
+    # A name which is not a table is scanned as a file by DuckDB (e.g. FROM 'data.csv')
+    if unknown_names := table_names - cte_names:
+        unknown_names -= {table_name for (table_name,) in cursor.execute(TABLE_NAMES_QUERY).fetchall()}
+    if unknown_names:
+        return f'the table {min(unknown_names)}'
+    return None
+
+
+async def synthesize_results(
     query: str, sql_query: str, db_results: list[dict[str, Any]], table_schema: dict[str, Any]
 ) -> Response:
     """
@@ -151,12 +547,18 @@ def synthesize_results(
     """
     llm = LLMRegistry.get()
 
-    response_str = llm.predict(
+    schema_text = format_table_schema(table_schema)
+    sql_response = format_sql_response(db_results)
+    # execute_sql returns at most SQL_RESULT_MAX_ROWS rows, tell the LLM so that it does not treat them as complete
+    if len(db_results) >= SQL_RESULT_MAX_ROWS:
+        sql_response += SQL_RESULT_TRUNCATED_NOTE.format(max_rows=SQL_RESULT_MAX_ROWS)
+
+    response_str = await llm.apredict(
         DEFAULT_RESPONSE_SYNTHESIS_PROMPT,
         sql_query=sql_query,
-        table_schema=table_schema,
-        sql_response=db_results,
+        table_schema=schema_text,
+        sql_response=sql_response,
         query_str=query,
     )
-    response_metadata = {'sql_query': sql_query, 'table_schema': str(table_schema)}
+    response_metadata = {'sql_query': sql_query, 'table_schema': schema_text}
     return Response(response=response_str, metadata=response_metadata)
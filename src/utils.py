@@ -1,10 +1,61 @@
+import asyncio
+import csv
+import io
 import logging
+from collections.abc import Coroutine
 from datetime import date, datetime, time
+from types import MappingProxyType
+from typing import Any
 
 from apify import Actor
 
 from .input_model import DatasetQueryEngine as ActorInput
 
+# Read-only map of common SQL types to Python types, DuckDB reports integer columns as INTEGER, BIGINT, etc.
+SQL_TYPE_MAPPINGS: MappingProxyType[str, type] = MappingProxyType(
+    {
+        'VARCHAR': str,
+        'CHAR': str,
+        'TEXT': str,
+        'TINYINT': int,  # Often a shortcut for an integer
+        'SMALLINT': int,
+        'INTEGER': int,
+        'BIGINT': int,
+        'HUGEINT': int,
+        'UTINYINT': int,
+        'USMALLINT': int,
+        'UINTEGER': int,
+        'UBIGINT': int,
+        'INT': int,
+        'DOUBLE': float,
+        'FLOAT': float,
+        'REAL': float,
+        'DECIMAL': float,
+        'NUMERIC': float,
+        'BOOLEAN': bool,
+        'BIT': bool,
+        'DATE': date,
+        'DATETIME': datetime,
+        'TIMESTAMP': datetime,
+        'TIMESTAMP WITH TIME ZONE': datetime,
+        'TIME': time,
+        'BLOB': bytes,
+        'BINARY': bytes,
+        'JSON': dict,
+    }
+)
+
+
+def run_async(main: Coroutine[Any, Any, None]) -> None:
+    """Run the coroutine on uvloop when it is installed (it is not available on Windows), otherwise on asyncio loop"""
+    try:
+        import uvloop
+    except ImportError:
+        asyncio.run(main)
+        return
+
+    uvloop.run(main)
+
 
 async def check_inputs(actor_input: ActorInput, payload: dict) -> ActorInput:
     """Check that provided input exists"""
@@ -37,8 +88,8 @@ def get_python_type(sql_type: str) -> type:
     """
     Map common SQL types to Python types.
 
-    If the type indicates an array (ends with "[]"), recursively map its element type
-    and return a `list` of that type.
+    If the type indicates an array (ends with "[]"), return `list`. Type parameters such as precision
+    (e.g., "DECIMAL(18,3)") are ignored, except for TINYINT(1) which is mapped to `bool`.
 
     :param sql_type: A string containing the SQL type (e.g., "VARCHAR", "TINYINT", "INTEGER[]").
     :return: A Python type corresponding to the given SQL type.
@@ -49,33 +100,31 @@ def get_python_type(sql_type: str) -> type:
     if sql_type.endswith('[]'):
         return list
 
-    # Map common SQL types to Python types.
-    sql_type_mappings = {
-        'VARCHAR': str,
-        'CHAR': str,
-        'TEXT': str,
-        'TINYINT': int,  # Often a shortcut for an integer
-        'SMALLINT': int,
-        'BIGINT': int,
-        'INT': int,
-        'DOUBLE': float,
-        'FLOAT': float,
-        'DECIMAL': float,
-        'NUMERIC': float,
-        'BOOLEAN': bool,
-        'BIT': bool,
-        'DATE': date,
-        'DATETIME': datetime,
-        'TIMESTAMP': datetime,
-        'TIME': time,
-        'BLOB': bytes,
-        'BINARY': bytes,
-        'JSON': dict,
-    }
-
     # Handle tinyint special cases (e.g., TINYINT(1)).
-    if sql_type.startswith('TINYINT') and '(1)' in sql_type:
+    if sql_type == 'TINYINT(1)':
         return bool
 
-    # Provide a fallback to `str` if the type is unrecognized.
-    return sql_type_mappings.get(sql_type, str)
+    # Drop type parameters (e.g., the precision and scale in DECIMAL(18,3)), fall back to `str` for unknown types
+    return SQL_TYPE_MAPPINGS.get(sql_type.partition('(')[0].rstrip(), str)
+
+
+def format_table_schema(table_schema: dict[str, Any]) -> str:
+    """Render the table schema for LLM prompts as `column:type` pairs, it is shorter than the dict repr"""
+    return ', '.join(f'{name}:{getattr(col_type, "__name__", col_type)}' for name, col_type in table_schema.items())
+
+
+def format_sql_response(rows: list[dict[str, Any]]) -> str:
+    """Render query results for LLM prompts as CSV, column names are written once instead of in every row"""
+    if not rows or not all(isinstance(row, dict) for row in rows):
+        return str(rows)
+    columns = list(dict.fromkeys(key for row in rows for key in row))
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(columns)
+    writer.writerows([row.get(column) for column in columns] for row in rows)
+    return buffer.getvalue()
+
+
+def quote_identifier(name: str) -> str:
+    """Quote a table name for DuckDB SQL, double quotes inside the name are escaped by doubling them"""
+    return '"' + name.replace('"', '""') + '"'
@@ -0,0 +1,38 @@
+import asyncio
+
+import pytest
+
+from src.batcher import MicroBatcher
+
+
+async def double(_: str, item: int) -> int:
+    return item * 2
+
+
+@pytest.mark.asyncio
+async def test_micro_batcher_coalesces_concurrent_items() -> None:
+    """Test that concurrent items with the same key are processed in one batch and lone items individually"""
+    batches: list[list[int]] = []
+
+    async def double_batch(_: str, items: list[int]) -> list[int]:
+        batches.append(items)
+        return [item * 2 for item in items]
+
+    batcher = MicroBatcher(double, double_batch, max_batch_size=10, max_wait_secs=0.01)
+
+    results = await asyncio.gather(*(batcher.submit('key', i) for i in range(3)), batcher.submit('other', 5))
+    assert results == [0, 2, 4, 10]
+    assert batches == [[0, 1, 2]]
+
+
+@pytest.mark.asyncio
+async def test_micro_batcher_propagates_errors() -> None:
+    """Test that a failing batch fails all of its items"""
+
+    async def fail_batch(_: str, items: list[int]) -> list[int]:
+        raise RuntimeError(f'Cannot process {items}')
+
+    batcher = MicroBatcher(double, fail_batch, max_batch_size=2, max_wait_secs=1)
+
+    results = await asyncio.gather(batcher.submit('key', 1), batcher.submit('key', 2), return_exceptions=True)
+    assert all(isinstance(result, RuntimeError) for result in results)
@@ -0,0 +1,47 @@
+from src.llm_cache import LRUCache, get_response_cache_key, get_schema_hash, get_sql_cache_key
+
+
+def test_lru_cache_evicts_least_recently_used() -> None:
+    """Test that the oldest unused entry is evicted when the cache is full"""
+    cache = LRUCache(maxsize=2)
+    cache.put('a', 1, 'dataset')
+    cache.put('b', 2, 'dataset')
+    assert cache.get('a') == 1
+    cache.put('c', 3, 'dataset')
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+
+
+def test_lru_cache_invalidate_dataset() -> None:
+    """Test that only entries of the given dataset are dropped"""
+    cache = LRUCache(maxsize=10)
+    cache.put('a', 1, 'dataset_a')
+    cache.put('b', 2, 'dataset_b')
+    assert cache.invalidate_dataset('dataset_a') == 1
+    assert cache.get('a') is None
+    assert cache.get('b') == 2
+
+
+def test_response_cache_key_normalizes_query() -> None:
+    """Test that the key ignores surrounding whitespace but not case, the schema or the answering path"""
+    schema_hash = get_schema_hash({'title': str, 'totalScore': float})
+    key = get_response_cache_key('gpt-4o-mini', 'dataset', schema_hash, "title = 'Lucia'", use_agent=True)
+    assert key == get_response_cache_key('gpt-4o-mini', 'dataset', schema_hash, "  title = 'Lucia' ", use_agent=True)
+    assert key != get_response_cache_key('gpt-4o-mini', 'dataset', schema_hash, "title = 'lucia'", use_agent=True)
+    assert key != get_response_cache_key('gpt-4o-mini', 'dataset', schema_hash, "title = 'Lucia'", use_agent=False)
+    assert key != get_response_cache_key(
+        'gpt-4o-mini', 'dataset', get_schema_hash({'title': str}), "title = 'Lucia'", use_agent=True
+    )
+    assert key != get_response_cache_key('gpt-4o', 'dataset', schema_hash, "title = 'Lucia'", use_agent=True)
+
+
+def test_sql_cache_key_keeps_query_case() -> None:
+    """Test that the key ignores surrounding whitespace and trailing question marks but not case or inner whitespace"""
+    schema_hash = get_schema_hash({'title': str})
+    key = get_sql_cache_key('gpt-4o-mini', 'dataset', schema_hash, "Restaurants named 'Lucia'")
+    assert key == get_sql_cache_key('gpt-4o-mini', 'dataset', schema_hash, " Restaurants named 'Lucia' ")
+    assert key == get_sql_cache_key('gpt-4o-mini', 'dataset', schema_hash, "\nRestaurants named 'Lucia' ?")
+    assert key != get_sql_cache_key('gpt-4o-mini', 'dataset', schema_hash, "Restaurants  named 'Lucia'")
+    assert key != get_sql_cache_key('gpt-4o-mini', 'dataset', schema_hash, "restaurants named 'lucia'")
+    assert key != get_sql_cache_key('gpt-4o-mini', 'other_dataset', schema_hash, "Restaurants named 'Lucia'")
@@ -1,6 +1,14 @@
+import asyncio
+from collections.abc import Sequence
+from typing import Any
+
 import pytest
+from llama_index.core.base.llms.types import ChatMessage, ChatResponse
+from llama_index.llms.openai import OpenAI
 from starlette.testclient import TestClient
 
+from src import main
+from src.llm_cache import LRUCache
 from src.main import app
 
 client = TestClient(app)
@@ -39,3 +47,53 @@ def test_unsupported_method() -> None:
     """Test unsupported HTTP method"""
     response = client.put('/')
     assert response.status_code == 405
+
+@pytest.mark.asyncio
+async def test_llm_concurrency_is_limited(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that concurrent LLM requests wait for a free slot of the shared semaphore"""
+    in_flight: list[int] = [0]
+    peak: list[int] = [0]
+
+    async def fake_achat(_self: OpenAI, _messages: Sequence[ChatMessage], **_kwargs: Any) -> ChatResponse:
+        in_flight[0] += 1
+        peak[0] = max(peak[0], in_flight[0])
+        await asyncio.sleep(0.01)
+        in_flight[0] -= 1
+        return ChatResponse(message=ChatMessage(content='answer'))
+
+    monkeypatch.setattr(OpenAI, 'achat', fake_achat)
+    monkeypatch.setattr(main, 'LLM_SEMAPHORE', asyncio.Semaphore(2))
+
+    llm = main.ConcurrencyLimitedOpenAI(model='gpt-4o-mini', api_key='test')
+    messages = [ChatMessage(content='question')]
+    responses = await asyncio.gather(*(llm.achat(messages) for _ in range(5)))
+    assert [response.message.content for response in responses] == ['answer'] * 5
+    assert peak[0] == 2
+
+@pytest.mark.asyncio
+async def test_sql_query_is_cached_under_the_path_taken(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that a SQL query is cached under the workflow path whether or not the agent was requested"""
+    workflow_queries: list[str] = []
+
+    async def fake_load_dataset(*_: Any, **__: Any) -> dict[str, Any]:
+        return {'title': str}
+
+    async def fake_run_workflow(query: str, **_: Any) -> Any:
+        workflow_queries.append(query)
+        return type('FakeResponse', (), {'response': 'answer'})()
+
+    async def fake_push_answer(*_: Any) -> None:
+        pass
+
+    monkeypatch.setattr(main, 'load_dataset', fake_load_dataset)
+    monkeypatch.setattr(main, 'run_workflow', fake_run_workflow)
+    monkeypatch.setattr(main, 'push_answer', fake_push_answer)
+    monkeypatch.setattr(main, 'response_cache', LRUCache(maxsize=4))
+
+    query = 'SELECT title FROM dataset'
+    for use_agent in (True, False):
+        actor_input = main.ACTOR_INPUT_ADAPTER.validate_python(
+            {'query': query, 'datasetId': 'cached_sql', 'useAgent': use_agent}
+        )
+        assert await main.process_query(actor_input) == 'answer'
+    assert workflow_queries == [query]
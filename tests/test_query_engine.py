@@ -0,0 +1,7 @@
+from src.query_engine import DATASET_TABLE_PATTERN
+
+
+def test_dataset_table_pattern_ignores_case() -> None:
+    """Test that the table placeholder is matched in any case but only as a whole word"""
+    query = 'SELECT datasetId FROM Dataset JOIN DATASET USING (id) WHERE dataset.id > 1'
+    assert DATASET_TABLE_PATTERN.sub('"t"', query) == 'SELECT datasetId FROM "t" JOIN "t" USING (id) WHERE "t".id > 1'
@@ -0,0 +1,10 @@
+from src._runtime import LOCAL_HOST, LOCAL_PORT, get_runtime
+
+
+def test_get_runtime_local() -> None:
+    """Test that the local runtime listens on localhost and is resolved only once"""
+    runtime = get_runtime()
+    assert runtime.host == LOCAL_HOST
+    assert runtime.port == LOCAL_PORT
+    assert runtime.actor_url == f'{LOCAL_HOST}:{LOCAL_PORT}'
+    assert get_runtime() is runtime
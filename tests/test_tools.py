@@ -0,0 +1,385 @@
+import asyncio
+import pathlib
+import re
+from datetime import UTC, datetime
+from typing import TYPE_CHECKING, Any
+
+import orjson
+import pytest
+from llama_index.core.base.llms.types import ChatMessage, ChatResponse
+
+from src import tools
+
+if TYPE_CHECKING:
+    from collections.abc import Iterator
+
+
+@pytest.mark.asyncio
+async def test_load_dataset_single_flight(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that concurrent loads of the same dataset fetch it only once and the schema and prompts are memoized"""
+    calls: list[str] = []
+
+    async def fake_load_dataset_table(dataset_id: str, **_: Any) -> dict[str, Any]:
+        calls.append(dataset_id)
+        await asyncio.sleep(0.01)
+        return {'title': str}
+
+    monkeypatch.setattr(tools, '_load_dataset_table', fake_load_dataset_table)
+    monkeypatch.setattr(tools, '_schema_cache', {})
+    monkeypatch.setattr(tools, '_schema_hashes', {})
+    monkeypatch.setattr(tools, '_prompt_cache', tools.LRUCache(maxsize=4))
+
+    schemas = await asyncio.gather(*(tools.load_dataset('single_flight') for _ in range(5)))
+    assert schemas == [{'title': str}] * 5
+    assert calls == ['single_flight']
+
+    # The hash of the loaded schema is memoized, an equal schema passed by the agent is hashed the same way
+    schema_hash = tools.get_table_schema_hash('single_flight', schemas[0])
+    assert schema_hash is tools._schema_hashes['single_flight']
+    assert tools.get_table_schema_hash('single_flight', {'title': str}) == schema_hash
+    assert tools.get_table_schema_hash('single_flight', {'garbled': str}) != schema_hash
+
+    prompts = tools._get_dataset_prompts('single_flight', schemas[0], schema_hash)
+    assert tools._get_dataset_prompts('single_flight', schemas[0], schema_hash) is prompts
+    assert "Table name: 'single_flight'" in prompts.text_to_sql.format(question='q')
+    garbled_schema = {'garbled': str}
+    garbled_prompts = tools._get_dataset_prompts('single_flight', garbled_schema, tools.get_schema_hash(garbled_schema))
+    assert garbled_prompts is not prompts
+
+    await tools.load_dataset('single_flight', refresh_dataset=True)
+    assert calls == ['single_flight', 'single_flight']
+    assert len(tools._prompt_cache) == 0
+
+
+@pytest.mark.asyncio
+async def test_load_dataset_refresh_replaces_table(monkeypatch: pytest.MonkeyPatch, tmp_path: pathlib.Path) -> None:
+    """Test that a refreshed dataset replaces its table and an unchanged one is not fetched again"""
+    versions: Iterator[list[dict[str, Any]]] = iter([[{'title': 'a'}], [{'title': 'b', 'totalScore': 4.5}]])
+    calls: list[str] = []
+
+    async def fake_fetch_dataset(dataset_id: str, **_: Any) -> None:
+        calls.append(dataset_id)
+        path = tmp_path / f'{len(calls)}.jsonl'
+        path.write_bytes(b'\n'.join(orjson.dumps(item) for item in next(versions)))
+        tools._create_table_from_json(dataset_id, [path])
+
+    monkeypatch.setattr(tools, '_fetch_dataset', fake_fetch_dataset)
+    monkeypatch.setattr(tools, '_schema_cache', {})
+
+    assert await tools.load_dataset('refresh_table') == {'title': str}
+    assert await tools.load_dataset('refresh_table') == {'title': str}
+    assert await tools.load_dataset('refresh_table', refresh_dataset=True) == {'title': str, 'totalScore': float}
+    assert calls == ['refresh_table', 'refresh_table']
+    # Queries run in worker threads, each with its own cursor, and must see the table
+    assert await asyncio.to_thread(tools.execute_sql, 'SELECT * FROM refresh_table') == [
+        {'title': 'b', 'totalScore': 4.5}
+    ]
+
+
+@pytest.mark.asyncio
+async def test_download_dataset_items_in_pages(monkeypatch: pytest.MonkeyPatch, tmp_path: pathlib.Path) -> None:
+    """Test that a large dataset is downloaded in pages which are loaded into one table in order"""
+    items = [{'title': f'item {i}', 'totalScore': i} if i % 2 else {'title': f'item {i}'} for i in range(5)]
+    requests: list[tuple[int | None, int | None]] = []
+
+    class FakeDatasetClient:
+        async def get_items_as_bytes(
+            self, item_format: str, offset: int | None = None, limit: int | None = None
+        ) -> bytes:
+            assert item_format == 'jsonl'
+            requests.append((offset, limit))
+            page = items[offset : offset + limit] if offset is not None and limit else items
+            return b'\n'.join(orjson.dumps(item) for item in page)
+
+    class FakeClient:
+        def dataset(self, _: str) -> FakeDatasetClient:
+            return FakeDatasetClient()
+
+    monkeypatch.setattr(tools, 'DATASET_PAGE_SIZE', 2)
+
+    paths = await tools._download_dataset_items(FakeClient(), 'paged', len(items), tmp_path)  # type: ignore[arg-type]
+    assert requests == [(0, 2), (2, 2), (4, 2)]
+
+    tools._create_table_from_json('paged', paths)
+    assert tools.execute_sql('SELECT title, totalScore FROM paged') == [
+        {'title': item['title'], 'totalScore': item.get('totalScore')} for item in items
+    ]
+
+
+@pytest.mark.asyncio
+async def test_download_dataset_items_cancels_pages_on_failure(
+    monkeypatch: pytest.MonkeyPatch, tmp_path: pathlib.Path
+) -> None:
+    """Test that a failed page download cancels the other pages instead of leaving them running"""
+    cancelled: list[int] = []
+
+    class FakeDatasetClient:
+        async def get_items_as_bytes(self, **kwargs: Any) -> bytes:
+            if kwargs['offset'] == 0:
+                raise RuntimeError('page failed')
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(kwargs['offset'])
+                raise
+            return b''
+
+    class FakeClient:
+        def dataset(self, _: str) -> FakeDatasetClient:
+            return FakeDatasetClient()
+
+    monkeypatch.setattr(tools, 'DATASET_PAGE_SIZE', 2)
+    monkeypatch.setattr(tools, 'DATASET_PAGE_CONCURRENCY', 3)
+
+    with pytest.raises(RuntimeError, match='page failed'):
+        await tools._download_dataset_items(FakeClient(), 'failing', 6, tmp_path)  # type: ignore[arg-type]
+    assert sorted(cancelled) == [2, 4]
+
+
+@pytest.mark.asyncio
+async def test_text_to_sql_batch_uses_json_mode() -> None:
+    """Test that batched SQL is matched by question number and a malformed answer falls back to single queries"""
+    answers: list[str] = []
+    response_formats: list[Any] = []
+
+    class FakeLLM:
+        async def achat(self, _: list[ChatMessage], response_format: Any) -> ChatResponse:
+            response_formats.append(response_format)
+            return ChatResponse(message=ChatMessage(content=answers.pop(0)))
+
+    answers_single = ['{"sql": "SELECT 1"}', '{"sql": "SELECT 2"}']
+    llm = FakeLLM()
+    items = [tools.TextToSQLItem(query, 'dataset', {'title': str}, 'hash', llm) for query in ('first', 'second')]  # type: ignore[arg-type]
+
+    answers.append('{"sql": [{"n": 2, "sql": " SELECT 2 "}, {"n": 1, "sql": "SELECT 1"}]}')
+    assert await tools._text_to_sql_batch('key', items) == ['SELECT 1', 'SELECT 2']
+
+    # The batched answer is not a list, so both queries are translated one by one
+    answers.extend(['{"sql": "SELECT"}', '{"sql": "SELECT 1"}', '{"sql": "SELECT 2"}'])
+    assert await tools._text_to_sql_batch('key', items) == ['SELECT 1', 'SELECT 2']
+
+    # A question number is missing, the SQL cannot be matched to its question
+    answers.extend(['{"sql": [{"n": 1, "sql": "SELECT 1"}, {"n": 1, "sql": "SELECT 2"}]}', *answers_single])
+    assert await tools._text_to_sql_batch('key', items) == ['SELECT 1', 'SELECT 2']
+    assert response_formats == [{'type': 'json_object'}] * 7
+
+
+@pytest.mark.asyncio
+async def test_sql_is_cached_only_after_it_runs(monkeypatch: pytest.MonkeyPatch, tmp_path: pathlib.Path) -> None:
+    """Test that a translation is cached once it executes, a failing one is translated again and a refresh drops it"""
+    translations = iter(['SELECT missing FROM sql_cached', 'SELECT title FROM sql_cached'])
+
+    async def fake_submit(*_: Any) -> str:
+        return next(translations)
+
+    monkeypatch.setattr(tools.text_to_sql_batcher, 'submit', fake_submit)
+    monkeypatch.setattr(tools.LLMRegistry, '_llm', type('FakeLLM', (), {'model': 'model'})())
+    monkeypatch.setattr(tools, 'sql_cache', tools.LRUCache(maxsize=4))
+    path = tmp_path / 'items.jsonl'
+    path.write_bytes(b'{"title": "a"}')
+    tools._create_table_from_json('sql_cached', [path])
+
+    sql_query = await tools.user_query_to_sql('titles', 'sql_cached', {'title': str})
+    with pytest.raises(ValueError, match='Invalid query'):
+        tools.execute_sql(sql_query)
+    sql_query = await tools.user_query_to_sql('titles', 'sql_cached', {'title': str})
+    assert sql_query == 'SELECT title FROM sql_cached'
+    assert len(tools.sql_cache) == 0
+
+    await asyncio.to_thread(tools.execute_sql, sql_query)
+    assert await tools.user_query_to_sql('titles', 'sql_cached', {'title': str}) == sql_query
+
+    async def fake_load_dataset_table(*_: Any, **__: Any) -> dict[str, Any]:
+        return {'title': str}
+
+    monkeypatch.setattr(tools, '_load_dataset_table', fake_load_dataset_table)
+    monkeypatch.setattr(tools, '_schema_cache', {})
+    await tools.load_dataset('sql_cached', refresh_dataset=True)
+    assert len(tools.sql_cache) == 0
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('content', ['{"sql": null}', '{"sql": ["SELECT 1"]}', '{"sql": {"query": "SELECT 1"}}'])
+async def test_text_to_sql_rejects_non_string_sql(content: str) -> None:
+    """Test that a `sql` value other than a string is reported instead of being executed as text like "None\" """
+
+    class FakeLLM:
+        async def achat(self, _: list[ChatMessage], **__: Any) -> ChatResponse:
+            return ChatResponse(message=ChatMessage(content=content))
+
+    item = tools.TextToSQLItem('question', 'dataset', {'title': str}, 'hash', FakeLLM())  # type: ignore[arg-type]
+    with pytest.raises(ValueError, match='Failed to parse SQL query generated for: question') as exc_info:
+        await tools._text_to_sql('key', item)
+    assert 'is not a string' in str(exc_info.value.__cause__)
+
+
+def test_execute_sql_invalid_query() -> None:
+    """Test that DuckDB errors are reported as invalid queries with the original message"""
+    with pytest.raises(ValueError, match='Invalid query.*missing_table'):
+        tools.execute_sql('SELECT * FROM missing_table')
+    with pytest.raises(ValueError, match='Invalid query: .*missing_column'):
+        tools.execute_sql('SELECT missing_column')
+    # Errors raised while the query runs, not while it is planned
+    with pytest.raises(ValueError, match='Invalid query: .*abc'):
+        tools.execute_sql("SELECT CAST('abc' AS INTEGER)")
+    with pytest.raises(ValueError, match='Invalid query: .*boom'):
+        tools.execute_sql("SELECT error('boom')")
+
+
+@pytest.mark.parametrize(
+    'sql_query', ['CREATE TABLE not_allowed AS SELECT 1', 'DROP TABLE IF EXISTS paged', 'SELECT 1; DROP TABLE paged']
+)
+def test_execute_sql_rejects_non_select(sql_query: str) -> None:
+    """Test that only a single SELECT statement is executed, shared tables cannot be modified"""
+    with pytest.raises(ValueError, match='only a single SELECT statement'):
+        tools.execute_sql(sql_query)
+    tables_query = "SELECT table_name FROM duckdb_tables() WHERE table_name = 'not_allowed'"
+    assert tools._get_cursor().execute(tables_query).fetchall() == []
+
+
+@pytest.mark.parametrize(
+    'sql_query',
+    [
+        "SELECT * FROM read_csv('/etc/hostname', header=false)",
+        "SELECT * FROM '/etc/hostname.csv'",
+        "WITH files AS (SELECT * FROM glob('/*')) SELECT * FROM files",
+        "SELECT (SELECT content FROM read_text('/etc/hostname'))",
+        "DESCRIBE SELECT * FROM read_parquet('/tmp/*.parquet')",
+        'SELECT * FROM duckdb_tables()',
+    ],
+)
+def test_execute_sql_rejects_file_access(sql_query: str) -> None:
+    """Test that a query cannot read files through table functions or file paths used as table names"""
+    with pytest.raises(ValueError, match='only the dataset table can be queried'):
+        tools.execute_sql(sql_query)
+
+
+def test_execute_sql_allows_table_references(tmp_path: pathlib.Path) -> None:
+    """Test that loaded tables, CTEs and unnest of a list column can be queried"""
+    path = tmp_path / 'items.jsonl'
+    path.write_bytes(b'{"title": "a", "tags": ["x", "y"]}')
+    tools._create_table_from_json('referenced', [path])
+
+    sql_query = 'WITH t AS (SELECT * FROM referenced) SELECT title, tag FROM t, unnest(t.tags) AS u(tag)'
+    assert tools.execute_sql(sql_query) == [{'title': 'a', 'tag': 'x'}, {'title': 'a', 'tag': 'y'}]
+
+
+@pytest.mark.asyncio
+async def test_synthesize_results_notes_truncated_response(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that the LLM is told when the SQL response was cut to the maximum number of rows"""
+    sql_responses: list[str] = []
+
+    class FakeLLM:
+        async def apredict(self, _: Any, **prompt_args: Any) -> str:
+            sql_responses.append(prompt_args['sql_response'])
+            return 'answer'
+
+    monkeypatch.setattr(tools.LLMRegistry, '_llm', FakeLLM())
+    monkeypatch.setattr(tools, 'SQL_RESULT_MAX_ROWS', 2)
+
+    await tools.synthesize_results('query', 'SELECT 1', [{'a': 1}], {'a': int})
+    await tools.synthesize_results('query', 'SELECT 1', [{'a': 1}, {'a': 2}], {'a': int})
+    assert sql_responses[0] == 'a\n1\n'
+    assert sql_responses[1].endswith('only its first 2 rows are shown.)')
+
+
+@pytest.mark.parametrize(
+    ('query', 'expected'),
+    [
+        ("SELECT * FROM dataset WHERE title = 'Lucia'", True),
+        ('WITH top AS (SELECT * FROM dataset) SELECT * FROM top', True),
+        ('FROM dataset SELECT title', True),
+        ('VALUES (1)', True),
+        ('(SELECT 1)', True),
+        ('Select the top 5 restaurants by rating', False),
+        ('With the most reviews, which restaurant is best?', False),
+        ('DROP TABLE dataset', False),
+    ],
+)
+def test_is_select_query(query: str, expected: bool) -> None:
+    """Test that only input parsing as a single SELECT is treated as SQL, not questions starting with a keyword"""
+    assert tools.is_select_query(query) is expected
+
+
+@pytest.mark.asyncio
+async def test_persisted_dataset_is_overwritten_in_place(
+    monkeypatch: pytest.MonkeyPatch, tmp_path: pathlib.Path
+) -> None:
+    """Test that a dataset is persisted under one valid key and only the copy of its current version is restored"""
+    records: dict[str, Any] = {}
+
+    class FakeStore:
+        async def get_value(self, key: str) -> Any:
+            return records.get(key)
+
+        async def set_value(self, key: str, value: Any, content_type: str | None = None) -> None:  # noqa: ARG002
+            if value is None:
+                records.pop(key, None)
+            else:
+                records[key] = value
+
+    async def fake_open_key_value_store(**_: Any) -> FakeStore:
+        return FakeStore()
+
+    monkeypatch.setattr(tools.Actor, 'open_key_value_store', fake_open_key_value_store)
+    path = tmp_path / 'items.jsonl'
+    path.write_bytes(b'{"title": "a"}')
+    tools._create_table_from_json('persisted', [path])
+
+    first = tools._get_persisted_dataset('user~persisted', {'modifiedAt': datetime(2025, 1, 1, tzinfo=UTC)})
+    second = tools._get_persisted_dataset('user~persisted', {'modifiedAt': datetime(2025, 1, 2, tzinfo=UTC)})
+    assert first is not None
+    assert second is not None
+    assert first.key == second.key
+    assert re.fullmatch(r"[a-zA-Z0-9!\-_.'()]+", first.version_key)
+
+    await tools._persist_dataset(first, 'persisted')
+    await tools._persist_dataset(second, 'persisted')
+    assert set(records) == {second.key, second.version_key}
+    assert not await tools._restore_persisted_dataset(first, 'restored', tmp_path)
+    assert await tools._restore_persisted_dataset(second, 'restored', tmp_path)
+    assert tools.execute_sql('SELECT title FROM restored') == [{'title': 'a'}]
+
+    monkeypatch.setattr(tools, 'DATASET_CACHE_MAX_BYTES', 0)
+    await tools._persist_dataset(second, 'persisted')
+    assert records == {}
+
+
+@pytest.mark.asyncio
+async def test_fetch_dataset_persists_only_when_enabled(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that the key-value store is used only with persist_dataset and the upload does not delay the load"""
+    uploaded = asyncio.Event()
+    restored: list[str] = []
+    persisted: list[str] = []
+
+    class FakeDatasetClient:
+        async def get(self) -> dict[str, Any]:
+            return {'itemCount': 1, 'modifiedAt': datetime(2025, 1, 1, tzinfo=UTC)}
+
+        async def get_items_as_bytes(self, **_: Any) -> bytes:
+            return b'{"title": "a"}'
+
+    class FakeClient:
+        def dataset(self, _: str) -> FakeDatasetClient:
+            return FakeDatasetClient()
+
+    async def fake_restore_persisted_dataset(_: tools.PersistedDataset, table_name: str, *__: Any) -> bool:
+        restored.append(table_name)
+        return False
+
+    async def fake_persist_dataset(_: tools.PersistedDataset, table_name: str) -> None:
+        await uploaded.wait()
+        persisted.append(table_name)
+
+    monkeypatch.setattr(tools, 'get_apify_client', FakeClient)
+    monkeypatch.setattr(tools, '_restore_persisted_dataset', fake_restore_persisted_dataset)
+    monkeypatch.setattr(tools, '_persist_dataset', fake_persist_dataset)
+
+    await tools._fetch_dataset('not_persisted')
+    await tools._fetch_dataset('persisted_later', persist_dataset=True)
+    assert restored == ['persisted_later']
+    assert persisted == []
+
+    uploaded.set()
+    await tools.wait_for_persisted_datasets()
+    assert persisted == ['persisted_later']
@@ -0,0 +1,35 @@
+from datetime import datetime
+from typing import Any
+
+from src.utils import format_sql_response, format_table_schema, get_python_type, quote_identifier
+
+
+def test_get_python_type_duckdb_types() -> None:
+    """Test that DuckDB column types, including parametrized ones, map to Python types"""
+    assert get_python_type('INTEGER') is int
+    assert get_python_type('bigint') is int
+    assert get_python_type('DECIMAL(18,3)') is float
+    assert get_python_type('TIMESTAMP WITH TIME ZONE') is datetime
+    assert get_python_type('VARCHAR[]') is list
+    assert get_python_type('TINYINT(1)') is bool
+    assert get_python_type('STRUCT(a INTEGER)') is str
+
+
+def test_format_table_schema() -> None:
+    """Test that the schema is rendered as column:type pairs"""
+    assert format_table_schema({'title': str, 'totalScore': float, 'other': 'JSON'}) == (
+        'title:str, totalScore:float, other:JSON'
+    )
+
+
+def test_format_sql_response() -> None:
+    """Test that rows are rendered as CSV with a single header and empty results are kept readable"""
+    rows: list[dict[str, Any]] = [{'title': 'Pizza, Inc.', 'totalScore': 4.5}, {'title': 'Bar', 'totalScore': None}]
+    assert format_sql_response(rows) == 'title,totalScore\n"Pizza, Inc.",4.5\nBar,\n'
+    assert format_sql_response([]) == '[]'
+
+
+def test_quote_identifier() -> None:
+    """Test that table names are quoted and embedded double quotes are escaped"""
+    assert quote_identifier('1dataset') == '"1dataset"'
+    assert quote_identifier('a"; DROP TABLE b; --') == '"a""; DROP TABLE b; --"'